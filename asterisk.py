@@ -1,32 +1,211 @@
-from functools import lru_cache
+import hashlib
 import os
 from pathlib import Path
+import pickle
+import re
+import shelve
+import shutil
+import sys
 import time
 
-from colorama import Fore, init
+import lark
 from lark import Lark
-from lark.exceptions import UnexpectedInput
+from lark.exceptions import UnexpectedEOF, UnexpectedInput, UnexpectedToken
+from lark.lexer import LexerThread
 
 from evaluation import Tree
 
-init(autoreset=True)
+
+class _PlainFore:
+    RED = ""
+    GREEN = ""
+
+
+# colorama is only imported when colours can be shown; scripts whose output
+# is piped or redirected skip the import entirely.
+Fore = _PlainFore
+if getattr(sys.stdout, "isatty", None) and sys.stdout.isatty():
+    import colorama
+
+    colorama.init(autoreset=True)
+    Fore = colorama.Fore
+
+VERSION = "1.0.0"
 
 GRAMMAR_PATH = Path(__file__).resolve().parent / "grammar" / "grammar.lark"
+GRAMMAR_TEXT = GRAMMAR_PATH.read_text(encoding="utf-8")
+GRAMMAR_HASH = hashlib.blake2b(GRAMMAR_TEXT.encode("utf-8"), digest_size=16).hexdigest()
+CACHE_DIR = Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache") / "asterisk"
+MODULE_CACHE_DIR = CACHE_DIR / "modules"
+REPL_CACHE_PATH = CACHE_DIR / "repl_trees"
+REPL_CACHE_LIMIT = 256
+PARSE_CACHE_MAX_BYTES = 8 * 1024 * 1024
 
-parser = Lark(
-    GRAMMAR_PATH.read_text(encoding="utf-8"),
-    parser="lalr",
-)
 
+def _strip_sigil(token):
+    return token.update(value=token[1:])
 
-@lru_cache(maxsize=256)
-def parse_cached(src):
+
+def _build_parser():
+    # Lark stores a hash of the grammar and options in the cache file and
+    # rebuilds it whenever they change, so a fixed path is safe.
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        cache = str(CACHE_DIR / "grammar.pkl")
+    except OSError:
+        cache = False
+    return Lark(
+        GRAMMAR_TEXT,
+        parser="lalr",
+        lexer_callbacks={"VAR": _strip_sigil},
+        cache=cache,
+    )
+
+
+parser = _build_parser()
+
+
+# (src, tree) pairs from earlier REPL sessions, keyed by _source_key(src).
+_warm_trees = {}
+# (src, tree) pairs for inputs run in this REPL session, saved on exit.
+_repl_history = {}
+
+
+def _source_key(src):
+    return hashlib.blake2b(src.encode("utf-8"), digest_size=8).hexdigest()
+
+
+# blake2b(src) -> [tree, UTF-8 size of src, compiled thunk for E or None].
+# Dict order is recency order; the total source size held is capped and a
+# source over the cap is never kept, so one large module cannot pin memory
+# the way a fixed entry count would let it.
+_parse_cache = {}
+_parse_cache_bytes = 0
+
+
+def _parse(src):
+    if _warm_trees:
+        entry = _warm_trees.get(_source_key(src))
+        if entry is not None and entry[0] == src:
+            return entry[1]
     return parser.parse(src)
 
 
+def _cache_entry(src, tree=None):
+    global _parse_cache_bytes
+    data = src.encode("utf-8")
+    if len(data) > PARSE_CACHE_MAX_BYTES:
+        return [_parse(src) if tree is None else tree, len(data), None]
+    key = hashlib.blake2b(data).digest()
+    entry = _parse_cache.pop(key, None)
+    if entry is None:
+        entry = [_parse(src) if tree is None else tree, len(data), None]
+        _parse_cache_bytes += entry[1]
+        while _parse_cache and _parse_cache_bytes > PARSE_CACHE_MAX_BYTES:
+            _parse_cache_bytes -= _parse_cache.pop(next(iter(_parse_cache)))[1]
+    _parse_cache[key] = entry
+    return entry
+
+
+def parse_cached(src):
+    return _cache_entry(src)[0]
+
+
+def clear_parse_cache():
+    global _parse_cache_bytes
+    _parse_cache.clear()
+    _parse_cache_bytes = 0
+
+
+def _cache_stamp():
+    return (GRAMMAR_HASH, lark.__version__, VERSION)
+
+
+def load_repl_cache():
+    try:
+        with shelve.open(str(REPL_CACHE_PATH), flag="r") as db:
+            if db.get("__stamp__") != _cache_stamp():
+                return
+            for key in db:
+                if key != "__stamp__":
+                    _warm_trees[key] = db[key]
+    except Exception:
+        # Missing, locked or unreadable cache: start cold.
+        pass
+
+
+def save_repl_cache():
+    entries = dict(_warm_trees)
+    for key, entry in _repl_history.items():
+        entries.pop(key, None)
+        entries[key] = entry
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        with shelve.open(str(REPL_CACHE_PATH), flag="n", protocol=pickle.HIGHEST_PROTOCOL) as db:
+            db["__stamp__"] = _cache_stamp()
+            for key, entry in list(entries.items())[-REPL_CACHE_LIMIT:]:
+                db[key] = entry
+    except Exception:
+        pass
+
+
+def clear_repl_cache():
+    _warm_trees.clear()
+    _repl_history.clear()
+    for path in CACHE_DIR.glob(f"{REPL_CACHE_PATH.name}*"):
+        try:
+            path.unlink(missing_ok=True)
+        except OSError:
+            # Best effort, like loading and saving: a file that cannot be
+            # removed is overwritten or ignored next time.
+            pass
+
+
+def _module_tree_cache_path(path):
+    key = f"{path}\0{GRAMMAR_HASH}\0{lark.__version__}\0{VERSION}"
+    return MODULE_CACHE_DIR / f"{hashlib.blake2b(key.encode('utf-8'), digest_size=16).hexdigest()}.pkl"
+
+
+# Parse trees of loaded modules are pickled to disk so a cold CLI run can
+# skip parsing them; src is None when the tree came from the disk cache.
+# Each module has one file holding (mtime, tree), rewritten when it changes.
+def parse_module(path, mtime):
+    cache_path = _module_tree_cache_path(path) if mtime is not None else None
+    if cache_path is not None:
+        try:
+            with open(cache_path, "rb") as f:
+                cached_mtime, tree = pickle.load(f)
+            if cached_mtime == mtime:
+                return None, tree
+        except Exception:
+            pass
+
+    src = path.read_text(encoding="utf-8")
+    try:
+        tree = parse_cached(src)
+    except UnexpectedInput as ex:
+        # Format here, while the source is at hand for the error context.
+        raise RuntimeError(pretty_err(src, ex)) from None
+    if cache_path is not None:
+        tmp_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+        try:
+            MODULE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                pickle.dump((mtime, tree), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, cache_path)
+        except Exception:
+            # Best effort, like the read above: a tree too deep to pickle
+            # (RecursionError) or an unwritable cache just goes uncached.
+            try:
+                tmp_path.unlink(missing_ok=True)
+            except OSError:
+                pass
+    return src, tree
+
+
 def pretty_err(src, ex):
     if isinstance(ex, UnexpectedInput):
-        ctx = ex.get_context(src)
+        ctx = ex.get_context(src) if src is not None else ""
         return f"{Fore.RED}Syntax error\n{"-"*20}\nLine  : {ex.line}\nColumn: {ex.column}\n{"-"*20}\n{ctx}"
     return str(ex)
 
@@ -42,19 +221,25 @@ def make_module_loader():
             path = base / path
         path = path.resolve()
 
-        if path in module_cache:
-            return module_cache[path]
+        # Keyed on mtime so a module edited during a session is reloaded.
+        try:
+            mtime = path.stat().st_mtime_ns
+        except OSError:
+            mtime = None
+        cached = module_cache.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
         if path in loading:
             raise RuntimeError(f"{Fore.RED}Circular module import: {path}")
 
         loading.add(path)
+        src = None
         try:
-            src = path.read_text(encoding="utf-8")
-            tree = parse_cached(src)
+            src, tree = parse_module(path, mtime)
             module_runtime = Tree(module_loader=load_module, current_dir=path.parent)
             module_runtime.transform(tree)
             exports = dict(module_runtime.env)
-            module_cache[path] = exports
+            module_cache[path] = (mtime, exports)
             return exports
         except FileNotFoundError:
             raise RuntimeError(f"{Fore.RED}Module not found: {path}") from None
@@ -69,14 +254,20 @@ def make_module_loader():
 E = Tree(module_loader=make_module_loader(), current_dir=Path.cwd())
 
 
+def compile_cached(src):
+    entry = _cache_entry(src)
+    if entry[2] is None:
+        entry[2] = E._compile(entry[0])
+    return entry[2]
+
+
 def run(src, source_path=None):
     try:
         if source_path is not None:
             E.current_dir = Path(source_path).resolve().parent
         else:
             E.current_dir = Path.cwd()
-        tree = parse_cached(src)
-        return E.transform(tree)
+        return compile_cached(src)()
     except Exception as ex:
         raise RuntimeError(f"{Fore.RED}{pretty_err(src, ex)}") from None
 
@@ -87,12 +278,55 @@ def run_file(path):
     return run(src, source_path=path)
 
 
-def _is_incomplete_source(src):
-    try:
-        parser.parse(src)
+def _is_eof_error(ex):
+    # LALR reports running out of input as an unexpected $END token.
+    return isinstance(ex, UnexpectedEOF) or (isinstance(ex, UnexpectedToken) and ex.token.type == "$END")
+
+
+# Strings and comments in lexer order; a bare "<*" is a comment still open.
+_COMMENT_SCAN = re.compile(r'"(?:\\.|[^"\\\n])*"|//[^\n]*|<\*[\s\S]*?\*>|<\*')
+
+
+def _open_comment(text):
+    for match in _COMMENT_SCAN.finditer(text):
+        if match.group() == "<*":
+            return match.start()
+    return -1
+
+
+class _ReplInput:
+    # Feeds each REPL line into one interactive LALR parser, so checking
+    # whether the buffer is complete does not reparse earlier lines.
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.state = parser.parse_interactive("")
+        self.comment = ""
+
+    def is_incomplete(self, line, src):
+        text = self.comment + line + "\n"
+        # An unclosed <* comment cannot be lexed a line at a time; hold it
+        # back until a later line closes it.
+        start = _open_comment(text)
+        self.comment = text[start:] if start >= 0 else ""
+        if start >= 0:
+            text = text[:start]
+        try:
+            self.state.lexer_thread = LexerThread.from_text(self.state.lexer_thread.lexer, text)
+            self.state.exhaust_lexer()
+        except UnexpectedInput:
+            return False
+        if self.comment:
+            return True
+        try:
+            tree = self.state.copy().feed_eof()
+        except UnexpectedInput as ex:
+            return _is_eof_error(ex)
+        # The buffer is complete and this is its tree; cache it under src so
+        # run() does not parse it again.
+        _cache_entry(src, tree)
         return False
-    except UnexpectedInput as ex:
-        return ex.pos_in_stream >= len(src)
 
 
 REPL_HELP = """Commands:
@@ -104,7 +338,7 @@ REPL_HELP = """Commands:
   :pwd                  show current directory
   :cd <path>            change current directory
   :time                 toggle execution time display
-  :cache clear          clear parse cache
+  :cache clear          clear parse, compile, module and REPL caches
 
 Notes:
   - Multi-line input is supported for blocks and unfinished expressions.
@@ -167,8 +401,10 @@ def _handle_repl_command(line, show_timing):
         print(f"Timing: {'on' if show_timing else 'off'}")
         return False, show_timing
     if cmd == ":cache clear":
-        parse_cached.cache_clear()
-        print("Parse cache cleared.")
+        clear_parse_cache()
+        shutil.rmtree(MODULE_CACHE_DIR, ignore_errors=True)
+        clear_repl_cache()
+        print("Parse, compile, module and REPL caches cleared.")
         return False, show_timing
 
     print(f"{Fore.RED}Unknown command: {cmd}")
@@ -178,7 +414,9 @@ def _handle_repl_command(line, show_timing):
 
 def repl():
     print(f"{Fore.GREEN}Asterisk REPL - Ctrl+C to clear line, :help for commands")
+    load_repl_cache()
     lines = []
+    pending = _ReplInput()
     show_timing = False
 
     while True:
@@ -191,6 +429,7 @@ def repl():
         except KeyboardInterrupt:
             print()
             lines.clear()
+            pending.reset()
             continue
 
         stripped = raw.strip()
@@ -208,13 +447,14 @@ def repl():
 
         lines.append(raw)
         src = "\n".join(lines)
-        if _is_incomplete_source(src):
+        if pending.is_incomplete(raw, src):
             continue
 
         try:
             started = time.perf_counter()
             v = run(src)
             elapsed_ms = (time.perf_counter() - started) * 1000.0
+            _repl_history[_source_key(src)] = (src, parse_cached(src))
             if v is not None:
                 print(repr(v))
             if show_timing:
@@ -223,18 +463,21 @@ def repl():
             print(f"{Fore.RED}{e}")
         finally:
             lines.clear()
+            pending.reset()
+
+    save_repl_cache()
 
 
 if __name__ == "__main__":
     import argparse
 
     p = argparse.ArgumentParser(
-        description="Asterisk Interpreter 1.0.0",
+        description=f"Asterisk Interpreter {VERSION}",
         usage="asterisk [options] [src]",
     )
 
     p.add_argument("src", nargs="?", default=None)
-    p.add_argument("--version", action="version", help="show version", version="%(prog)s 1.0.0")
+    p.add_argument("--version", action="version", help="show version", version=f"%(prog)s {VERSION}")
     p.add_argument("--repl", action="store_true")
     args = p.parse_args()
 
@@ -1,433 +1,780 @@
+from array import array
 import ast
+from functools import lru_cache
 from pathlib import Path
+import sys
 
 from lark import Tree as LarkTree
 from lark.visitors import Interpreter
 
 
-class LoopBreak(Exception):
-    pass
+# Control-flow status word: break/continue/return set Tree._status and
+# return normally; blocks stop at the first non-zero status and the
+# enclosing loop or function consumes it.
+_NORMAL = 0
+_BREAK = 1
+_CONTINUE = 2
+_RETURN = 3
 
+_UNBOUND = object()
+_NOT_CONSTANT = object()
 
-class LoopContinue(Exception):
-    pass
+# Rules whose value may be known at compile time; see Tree._constant.
+_CONSTANT_RULES = frozenset({"number", "string", "true", "false", "tuple_empty", "neg", "not_op", "grouped"})
 
 
-class FunctionReturn(Exception):
-    def __init__(self, value):
-        super().__init__()
-        self.value = value
+def _get_list(target, index):
+    if not isinstance(index, int):
+        raise TypeError("list index must be int")
+    return target[index]
 
 
-class Tree(Interpreter):
-    def __init__(self, module_loader=None, current_dir=None):
-        super().__init__()
-        self.env = {}
-        self.local_scopes = []
-        self.module_loader = module_loader
-        self.current_dir = Path(current_dir).resolve() if current_dir else None
-        self.loop_depth = 0
-        self.function_depth = 0
-        self.builtins = {
-            "putln": lambda *x: print(*x),
-            "scan": lambda x: input(x),
-            "length": lambda x: len(x),
-        }
+def _get_tuple(target, index):
+    if not isinstance(index, int):
+        raise TypeError("tuple index must be int")
+    return target[index]
 
-    def transform(self, tree):
-        return self.visit(tree)
 
-    def _eval(self, node):
-        if isinstance(node, LarkTree):
-            return self.visit(node)
-        return node
-
-    def _lookup_var(self, name):
-        for scope in reversed(self.local_scopes):
-            if name in scope:
-                return scope[name]
-        if name in self.env:
-            return self.env[name]
-        if name in self.builtins:
-            return self.builtins[name]
-        raise KeyError(name)
-
-    def _lookup_user_var(self, name):
-        for scope in reversed(self.local_scopes):
-            if name in scope:
-                return scope[name]
-        if name in self.env:
-            return self.env[name]
-        raise KeyError(name)
-
-    def _set_var(self, name, value):
-        if self.local_scopes:
-            self.local_scopes[-1][name] = value
-        else:
-            self.env[name] = value
-        return value
+def _get_dict(target, index):
+    try:
+        return target[index]
+    except TypeError as ex:
+        raise TypeError("dict key is not hashable") from ex
+    except KeyError as ex:
+        raise KeyError(f"dict key not found: {index}") from ex
 
-    def _current_scope(self):
-        if self.local_scopes:
-            return self.local_scopes[-1]
-        return self.env
 
-    def start(self, tree):
-        last = None
-        for stmt in tree.children:
-            last = self._eval(stmt)
-        return last
+def _set_list(target, index, value):
+    if not isinstance(index, int):
+        raise TypeError("list index must be int")
+    target[index] = value
+    return value
 
-    def block(self, tree):
-        last = None
-        for stmt in tree.children:
-            last = self._eval(stmt)
-        return last
 
-    def number(self, tree):
-        s = str(tree.children[0])
-        return float(s) if any(c in s for c in ".eE") else int(s)
+def _set_dict(target, index, value):
+    try:
+        target[index] = value
+    except TypeError as ex:
+        raise TypeError("dict key is not hashable") from ex
+    return value
 
-    def string(self, tree):
-        return ast.literal_eval(tree.children[0])
 
-    def true(self, tree):
-        return True
+def _module_member(mod, module_name, member):
+    if not isinstance(mod, dict):
+        raise NameError(f"undefined module: {module_name}")
+    if member not in mod:
+        raise NameError(f"undefined module member: {module_name}.{member}")
+    return mod[member]
 
-    def false(self, tree):
-        return False
 
-    def var(self, tree):
-        n = str(tree.children[0])
-        try:
-            return self._lookup_var(n)
-        except KeyError as ex:
-            raise NameError(f"undefined variable: {n}") from ex
-
-    def assign_var(self, tree):
-        name = str(tree.children[0])
-        value = self._eval(tree.children[1])
-        return self._set_var(name, value)
-
-    def assign_index(self, tree):
-        name = str(tree.children[0])
-        index = self._eval(tree.children[1])
-        value = self._eval(tree.children[2])
-        try:
-            target = self._lookup_user_var(name)
-        except KeyError as ex:
-            raise NameError(f"undefined variable: {name}") from ex
-        if isinstance(target, list):
-            if not isinstance(index, int):
-                raise TypeError("list index must be int")
-            target[index] = value
-            return value
-        if isinstance(target, dict):
-            try:
-                target[index] = value
-            except TypeError as ex:
-                raise TypeError("dict key is not hashable") from ex
-            return value
-        raise TypeError(f"{name} is not indexable")
+def _name(token):
+    # Identifiers are interned once at compile time so env/module dict
+    # lookups hit CPython's identity fast path for string keys.
+    return sys.intern(str(token))
 
-    def import_stmt(self, tree):
-        if self.module_loader is None:
-            raise RuntimeError("module system is not configured")
 
-        raw_path = ast.literal_eval(tree.children[0])
-        alias = tree.children[1] if len(tree.children) > 1 else None
-        module_name = str(alias) if alias is not None else Path(raw_path).stem
-        module_value = self.module_loader(raw_path, self.current_dir)
-        return self._set_var(module_name, module_value)
+_MAX_CHAIN = 32
 
-    def params(self, tree):
-        return [str(child) for child in tree.children]
 
-    def func_def(self, tree):
-        func_name = str(tree.children[0])
-        if len(tree.children) == 3 and tree.children[1] is not None:
-            param_names = self._eval(tree.children[1]) or []
-        else:
-            param_names = []
-        block_node = tree.children[-1]
+@lru_cache(maxsize=256)
+def _arith_chain(ops):
+    # Build a factory for one closure that evaluates a whole left-associative
+    # +/- chain, e.g. ("+", "-") -> lambda: t0() + t1() - t2().
+    params = ", ".join(f"t{i}" for i in range(len(ops) + 1))
+    expr = "t0()" + "".join(f" {op} t{i}()" for i, op in enumerate(ops, 1))
+    namespace = {}
+    exec(f"def make({params}):\n    return lambda: {expr}\n", namespace)
+    return namespace["make"]
 
-        def user_function(*args):
-            if len(args) != len(param_names):
-                raise TypeError(
-                    f"{func_name}() takes {len(param_names)} argument(s) but {len(args)} were given"
-                )
 
-            local_env = {}
-            for name, value in zip(param_names, args):
-                local_env[name] = value
+def _arity_error(func_name, args, extra):
+    given = sum(arg is not _UNBOUND for arg in args) + len(extra)
+    return TypeError(f"{func_name}() takes {len(args)} argument(s) but {given} were given")
 
-            self.local_scopes.append(local_env)
-            self.function_depth += 1
-            try:
-                return self._eval(block_node)
-            except FunctionReturn as returned:
-                return returned.value
-            finally:
-                self.function_depth -= 1
-                self.local_scopes.pop()
 
-        self._set_var(func_name, user_function)
-        return user_function
+_FUNCTION_TEMPLATE = """\
+def make(__rt, __body, __parent, __name):
+    def user_function({signature}):
+        if {missing}:
+            raise __arity_error(__name, ({args}), __extra)
+        __caller = __rt.frame
+        __rt.frame = {frame}
+        try:
+            return __body()
+        finally:
+            __rt._status = {normal}
+            __rt.frame = __caller
+    return user_function
+"""
+
+
+@lru_cache(maxsize=256)
+def _function_factory(param_names, nslots, read_only, linked):
+    # Generate a user function with one positional parameter per declared
+    # parameter, so the frame is built from a single literal. Parameters
+    # default to __unbound and extras land in __extra, so a wrong argument
+    # count is caught by one test on the last parameter and reported the
+    # same way whatever the declared names are.
+    params = [f"__a{i}" for i in range(len(param_names))]
+    # A nested function keeps its enclosing frame in the slot after its own.
+    link = ["__parent"] if linked else []
+    if read_only:
+        # A body that never assigns only reads its frame, so a tuple will do.
+        items = params + link
+        frame = f"({', '.join(items)}{',' if len(items) == 1 else ''})"
+    else:
+        frame = f"[{', '.join(params + ['__unbound'] * (nslots - len(params)) + link)}]"
+    source = _FUNCTION_TEMPLATE.format(
+        signature=", ".join([f"{p}=__unbound" for p in params] + ["*__extra"]),
+        missing=f"__extra or {params[-1]} is __unbound" if params else "__extra",
+        args="".join(f"{p}, " for p in params),
+        frame=frame,
+        normal=_NORMAL,
+    )
+    namespace = {"__unbound": _UNBOUND, "__arity_error": _arity_error}
+    exec(source, namespace)
+    return namespace["make"]
+
+
+# array.array shares the list protocol, so host code can bind typed numeric
+# arrays into env and index them through the same fast path.
+_INDEX_GETTERS = {list: _get_list, tuple: _get_tuple, dict: _get_dict, array: _get_list}
+_INDEX_SETTERS = {list: _set_list, dict: _set_dict, array: _set_list}
+
+
+def _index_handler(handlers, target):
+    handler = handlers.get(type(target))
+    if handler is None:
+        for kind, candidate in handlers.items():
+            if isinstance(target, kind):
+                return candidate
+    return handler
 
-    def if_stmt(self, tree):
-        condition = self._eval(tree.children[0])
-        then_block = tree.children[1]
 
-        if condition:
-            return self._eval(then_block)
+class Tree(Interpreter):
+    def __init__(self, module_loader=None, current_dir=None):
+        super().__init__()
+        self.env = {}
+        self.frame = None
+        self.module_loader = module_loader
+        self.current_dir = Path(current_dir).resolve() if current_dir else None
+        self._status = _NORMAL
+        self.builtins = {
+            "putln": lambda *x: print(*x),
+            "scan": lambda x: input(x),
+            "length": len,
+        }
+        self._compile_scope = None
+        self._compile_link = None
+        self._compile_enclosing = ()
+        self._compile_loops = 0
 
-        for node in tree.children[2:]:
-            if isinstance(node, LarkTree) and node.data == "elseif_clause":
-                elseif_condition, elseif_block = self._eval(node)
-                if elseif_condition:
-                    return self._eval(elseif_block)
-            else:
-                return self._eval(node)
+    def transform(self, tree):
+        if not isinstance(tree, LarkTree):
+            return tree
+        return self._compile(tree)()
+
+    def __default__(self, tree):
+        return self.transform(tree)
+
+    # Each LarkTree is lowered once into a nullary closure so loops re-run
+    # prebuilt thunks instead of re-dispatching through visit().
+
+    def _compile(self, node):
+        if not isinstance(node, LarkTree):
+            return lambda: node
+        if node.data in _CONSTANT_RULES:
+            value = self._constant(node)
+            if value is not _NOT_CONSTANT:
+                return lambda: value
+        # Looked up on the class: Interpreter.__getattr__ answers every
+        # missing name on the instance with __default__.
+        compiler = getattr(type(self), f"_compile_{node.data}", None)
+        if compiler is None:
+            # Same result as Interpreter.visit_children: the children's values.
+            thunks = [self._compile(child) for child in node.children]
+            return lambda: [thunk() for thunk in thunks]
+        return compiler(self, node)
+
+    # Names assigned inside a function body are resolved to fixed slots in
+    # that function's frame list; names assigned in an enclosing function
+    # are reached through the frame captured when the inner one was defined;
+    # everything else is a global or builtin.
+
+    def _compile_load(self, name, missing, builtins=True):
+        env = self.env
+        builtin = self.builtins.get(name) if builtins else None
+
+        def load_global():
+            try:
+                return env[name]
+            except KeyError:
+                if builtin is not None:
+                    return builtin
+                raise NameError(missing) from None
+
+        # (links to follow from the current frame, slot) per scope binding name.
+        candidates = []
+        scope = self._compile_scope
+        if scope is not None and name in scope:
+            candidates.append(((), scope[name]))
+        path, link = (), self._compile_link
+        for outer_scope, outer_link in self._compile_enclosing:
+            path += (link,)
+            if name in outer_scope:
+                candidates.append((path, outer_scope[name]))
+            link = outer_link
+
+        if not candidates:
+            return load_global
+        if len(candidates) == 1 and not candidates[0][0]:
+            slot = candidates[0][1]
+
+            def load_local():
+                value = self.frame[slot]
+                if value is _UNBOUND:
+                    return load_global()
+                return value
+
+            return load_local
+
+        def load_scoped():
+            for links, slot in candidates:
+                frame = self.frame
+                for link in links:
+                    frame = frame[link]
+                value = frame[slot]
+                if value is not _UNBOUND:
+                    return value
+            return load_global()
+
+        return load_scoped
+
+    def _compile_store(self, name, value_thunk):
+        scope = self._compile_scope
+        if scope is None:
+            env = self.env
+
+            def store_global():
+                value = env[name] = value_thunk()
+                return value
+
+            return store_global
+        slot = scope[name]
+
+        def store_local():
+            value = self.frame[slot] = value_thunk()
+            return value
 
-        return None
+        return store_local
 
-    def elseif_clause(self, tree):
-        condition = self._eval(tree.children[0])
-        block = tree.children[1]
-        return condition, block
+    @staticmethod
+    def _module_name(node):
+        alias = node.children[1] if len(node.children) > 1 else None
+        return _name(alias if alias is not None else Path(ast.literal_eval(node.children[0])).stem)
 
-    def while_stmt(self, tree):
-        condition_node = tree.children[0]
-        block_node = tree.children[1]
-        last = None
-        self.loop_depth += 1
-        try:
-            while self._eval(condition_node):
-                try:
-                    last = self._eval(block_node)
-                except LoopContinue:
+    def _collect_locals(self, node, names):
+        for child in node.children:
+            if not isinstance(child, LarkTree):
+                continue
+            if child.data in ("assign_var", "for_stmt", "func_def"):
+                names.setdefault(_name(child.children[0]), len(names))
+                if child.data == "func_def":
                     continue
-                except LoopBreak:
-                    break
-        finally:
-            self.loop_depth -= 1
-        return last
-
-    def for_stmt(self, tree):
-        loop_var = str(tree.children[0])
-        iterable = self._eval(tree.children[1])
-        block_node = tree.children[2]
+            elif child.data == "import_stmt":
+                names.setdefault(self._module_name(child), len(names))
+            self._collect_locals(child, names)
+        return names
 
+    def _compile_argv(self, node):
+        if node is None:
+            return []
+        return [self._compile(child) for child in node.children]
+
+    def _compile_start(self, node):
+        thunks = [self._compile(child) for child in node.children]
+
+        # Top-level loops consume break/continue and return is rejected at
+        # compile time, so the status word is always clear here.
+        def run():
+            last = None
+            for thunk in thunks:
+                last = thunk()
+            return last
+
+        return run
+
+    def _compile_block(self, node):
+        thunks = [self._compile(child) for child in node.children]
+        if not thunks:
+            return lambda: None
+        if len(thunks) == 1:
+            return thunks[0]
+
+        def run():
+            last = None
+            for thunk in thunks:
+                last = thunk()
+                if self._status:
+                    break
+            return last
+
+        return run
+
+    def _constant(self, node):
+        if not isinstance(node, LarkTree):
+            return _NOT_CONSTANT
+        kind = node.data
+        if kind == "number":
+            s = str(node.children[0])
+            return float(s) if any(c in s for c in ".eE") else int(s)
+        if kind == "string":
+            return ast.literal_eval(node.children[0])
+        if kind == "true":
+            return True
+        if kind == "false":
+            return False
+        if kind == "tuple_empty":
+            return ()
+        if kind == "grouped":
+            return self._constant(node.children[0])
+        if kind in ("neg", "not_op"):
+            value = self._constant(node.children[0])
+            if value is _NOT_CONSTANT:
+                return value
+            if kind == "not_op":
+                return not value
+            try:
+                return -value
+            except TypeError:
+                # Leave the error (e.g. -"a") to be raised at runtime.
+                return _NOT_CONSTANT
+        return _NOT_CONSTANT
+
+    def _compile_var(self, node):
+        n = _name(node.children[0])
+        return self._compile_load(n, f"undefined variable: {n}")
+
+    def _compile_assign_var(self, node):
+        name = _name(node.children[0])
+        return self._compile_store(name, self._compile(node.children[1]))
+
+    def _compile_assign_index(self, node):
+        name = _name(node.children[0])
+        load_target = self._compile_load(name, f"undefined variable: {name}", builtins=False)
+        index_thunk = self._compile(node.children[1])
+        value_thunk = self._compile(node.children[2])
+
+        # Monomorphic inline cache: [target type, setter] from the last call.
+        cache = [None, None]
+
+        def store():
+            index = index_thunk()
+            value = value_thunk()
+            target = load_target()
+            if type(target) is cache[0]:
+                return cache[1](target, index, value)
+            setter = _index_handler(_INDEX_SETTERS, target)
+            if setter is None:
+                raise TypeError(f"{name} is not indexable")
+            cache[0], cache[1] = type(target), setter
+            return setter(target, index, value)
+
+        return store
+
+    def _compile_import_stmt(self, node):
+        raw_path = ast.literal_eval(node.children[0])
+
+        def load_module():
+            if self.module_loader is None:
+                raise RuntimeError("module system is not configured")
+            return self.module_loader(raw_path, self.current_dir)
+
+        return self._compile_store(self._module_name(node), load_module)
+
+    def _compile_func_def(self, node):
+        func_name = _name(node.children[0])
+        if len(node.children) == 3 and node.children[1] is not None:
+            param_names = [_name(child) for child in node.children[1].children]
+        else:
+            param_names = []
+        assigned = self._collect_locals(node.children[-1], {})
+        # A repeated parameter binds its last position, so locals are numbered
+        # from the parameter count rather than from the number of names.
+        slots = {name: i for i, name in enumerate(param_names)}
+        nslots = len(param_names)
+        for name in assigned:
+            if name not in slots:
+                slots[name] = nslots
+                nslots += 1
+        nested = self._compile_scope is not None
+        make = _function_factory(tuple(param_names), nslots, not assigned, nested)
+
+        outer = (self._compile_scope, self._compile_link, self._compile_enclosing, self._compile_loops)
+        if nested:
+            self._compile_enclosing = ((self._compile_scope, self._compile_link),) + self._compile_enclosing
+        self._compile_scope, self._compile_link, self._compile_loops = slots, nslots if nested else None, 0
         try:
-            iterator = iter(iterable)
-        except TypeError as ex:
-            raise TypeError("for target is not iterable") from ex
-
-        scope = self._current_scope()
-        had_old = loop_var in scope
-        old_value = scope.get(loop_var)
-        last = None
-
-        self.loop_depth += 1
+            body = self._compile(node.children[-1])
+        finally:
+            self._compile_scope, self._compile_link, self._compile_enclosing, self._compile_loops = outer
+
+        def define():
+            user_function = make(self, body, self.frame if nested else None, func_name)
+            user_function.__name__ = user_function.__qualname__ = func_name
+            return user_function
+
+        return self._compile_store(func_name, define)
+
+    def _compile_if_stmt(self, node):
+        branches = [(self._compile_test(node.children[0]), self._compile(node.children[1]))]
+        otherwise = None
+        for child in node.children[2:]:
+            if isinstance(child, LarkTree) and child.data == "elseif_clause":
+                branches.append((self._compile_test(child.children[0]), self._compile(child.children[1])))
+            elif child is not None:
+                otherwise = self._compile(child)
+
+        if len(branches) == 1:
+            (condition, body), = branches
+            if otherwise is None:
+                return lambda: body() if condition() else None
+            return lambda: body() if condition() else otherwise()
+
+        def run():
+            for condition, body in branches:
+                if condition():
+                    return body()
+            if otherwise is not None:
+                return otherwise()
+            return None
+
+        return run
+
+    def _compile_loop_body(self, node):
+        self._compile_loops += 1
         try:
-            for item in iterator:
-                scope[loop_var] = item
-                try:
-                    last = self._eval(block_node)
-                except LoopContinue:
-                    continue
-                except LoopBreak:
-                    break
+            return self._compile(node)
         finally:
-            self.loop_depth -= 1
-            if had_old:
-                scope[loop_var] = old_value
-            else:
-                scope.pop(loop_var, None)
-
-        return last
-
-    def break_stmt(self, tree):
-        if self.loop_depth <= 0:
-            raise RuntimeError("break used outside of loop")
-        raise LoopBreak()
-
-    def continue_stmt(self, tree):
-        if self.loop_depth <= 0:
-            raise RuntimeError("continue used outside of loop")
-        raise LoopContinue()
-
-    def return_stmt(self, tree):
-        if self.function_depth <= 0:
-            raise RuntimeError("return used outside of function")
-        value = self._eval(tree.children[0]) if tree.children else None
-        raise FunctionReturn(value)
-
-    def add(self, tree):
-        return self._eval(tree.children[0]) + self._eval(tree.children[1])
-
-    def sub(self, tree):
-        return self._eval(tree.children[0]) - self._eval(tree.children[1])
-
-    def eq(self, tree):
-        return self._eval(tree.children[0]) == self._eval(tree.children[1])
-
-    def ne(self, tree):
-        return self._eval(tree.children[0]) != self._eval(tree.children[1])
-
-    def lt(self, tree):
-        return self._eval(tree.children[0]) < self._eval(tree.children[1])
-
-    def le(self, tree):
-        return self._eval(tree.children[0]) <= self._eval(tree.children[1])
-
-    def gt(self, tree):
-        return self._eval(tree.children[0]) > self._eval(tree.children[1])
-
-    def ge(self, tree):
-        return self._eval(tree.children[0]) >= self._eval(tree.children[1])
-
-    def and_op(self, tree):
-        left = self._eval(tree.children[0])
-        if not left:
-            return False
-        return bool(self._eval(tree.children[1]))
-
-    def or_op(self, tree):
-        left = self._eval(tree.children[0])
-        if left:
-            return True
-        return bool(self._eval(tree.children[1]))
-
-    def mul(self, tree):
-        return self._eval(tree.children[0]) * self._eval(tree.children[1])
-
-    def div(self, tree):
-        x = self._eval(tree.children[0])
-        y = self._eval(tree.children[1])
-        if y == 0:
-            raise ZeroDivisionError(f"division by zero: {x} / {y}")
-        return x / y
-
-    def neg(self, tree):
-        return -self._eval(tree.children[0])
-
-    def not_op(self, tree):
-        return not self._eval(tree.children[0])
-
-    def grouped(self, tree):
-        return self._eval(tree.children[0])
+            self._compile_loops -= 1
+
+    def _compile_while_stmt(self, node):
+        condition = self._compile_test(node.children[0])
+        body = self._compile_loop_body(node.children[1])
+
+        def run():
+            last = None
+            while condition():
+                value = body()
+                status = self._status
+                if status:
+                    if status == _RETURN:
+                        return value
+                    self._status = _NORMAL
+                    if status == _BREAK:
+                        break
+                    continue
+                last = value
+            return last
 
-    def tuple_empty(self, tree):
-        return ()
+        return run
 
-    def tuple_literal(self, tree):
-        head = self._eval(tree.children[0])
-        tail = self._eval(tree.children[1]) if len(tree.children) > 1 else []
-        if tail is None:
-            tail = []
-        return tuple([head, *tail])
+    def _compile_for_stmt(self, node):
+        loop_var = _name(node.children[0])
+        iterable_thunk = self._compile(node.children[1])
+        body = self._compile_loop_body(node.children[2])
 
-    def list_literal(self, tree):
-        if not tree.children:
-            return []
-        values = self._eval(tree.children[0])
-        return values if values is not None else []
-
-    def dict_item(self, tree):
-        key = self._eval(tree.children[0])
-        value = self._eval(tree.children[1])
-        return key, value
-
-    def dict_items(self, tree):
-        return [self._eval(child) for child in tree.children]
-
-    def dict_literal(self, tree):
-        if not tree.children:
-            return {}
-        items = self._eval(tree.children[0])
-        if items is None:
-            return {}
-        result = {}
-        for key, value in items:
+        def iterate():
             try:
-                result[key] = value
+                return iter(iterable_thunk())
             except TypeError as ex:
-                raise TypeError("dict key is not hashable") from ex
-        return result
-
-    def var_index(self, tree):
-        name = str(tree.children[0])
-        index = self._eval(tree.children[1])
-        try:
-            target = self._lookup_user_var(name)
-        except KeyError as ex:
-            raise NameError(f"undefined variable: {name}") from ex
-        if isinstance(target, list):
-            if not isinstance(index, int):
-                raise TypeError("list index must be int")
-            return target[index]
-        if isinstance(target, tuple):
-            if not isinstance(index, int):
-                raise TypeError("tuple index must be int")
-            return target[index]
-        if isinstance(target, dict):
+                raise TypeError("for target is not iterable") from ex
+
+        if self._compile_scope is not None:
+            # Function-local loop variable: one slot store per item, no restore.
+            slot = self._compile_scope[loop_var]
+
+            def run_local():
+                iterator = iterate()
+                frame = self.frame
+                last = None
+                for item in iterator:
+                    frame[slot] = item
+                    value = body()
+                    status = self._status
+                    if status:
+                        if status == _RETURN:
+                            return value
+                        self._status = _NORMAL
+                        if status == _BREAK:
+                            break
+                        continue
+                    last = value
+                return last
+
+            return run_local
+
+        def run_global():
+            iterator = iterate()
+            env = self.env
+            old_value = env.get(loop_var, _UNBOUND)
+            last = None
             try:
-                return target[index]
-            except TypeError as ex:
-                raise TypeError("dict key is not hashable") from ex
-            except KeyError as ex:
-                raise KeyError(f"dict key not found: {index}") from ex
-        raise TypeError(f"{name} is not indexable")
+                for item in iterator:
+                    env[loop_var] = item
+                    value = body()
+                    status = self._status
+                    if status:
+                        self._status = _NORMAL
+                        if status == _BREAK:
+                            break
+                        continue
+                    last = value
+            finally:
+                if old_value is _UNBOUND:
+                    env.pop(loop_var, None)
+                else:
+                    env[loop_var] = old_value
+            return last
 
-    def args(self, tree):
-        return [self._eval(child) for child in tree.children]
+        return run_global
+
+    @staticmethod
+    def _compile_misplaced(message):
+        def run():
+            raise RuntimeError(message)
+
+        return run
+
+    def _compile_break_stmt(self, node):
+        if self._compile_loops <= 0:
+            return self._compile_misplaced("break used outside of loop")
+
+        def run():
+            self._status = _BREAK
+
+        return run
+
+    def _compile_continue_stmt(self, node):
+        if self._compile_loops <= 0:
+            return self._compile_misplaced("continue used outside of loop")
+
+        def run():
+            self._status = _CONTINUE
+
+        return run
+
+    def _compile_return_stmt(self, node):
+        if self._compile_scope is None:
+            return self._compile_misplaced("return used outside of function")
+        value = self._compile(node.children[0]) if node.children and node.children[0] is not None else None
+
+        def run():
+            result = value() if value is not None else None
+            self._status = _RETURN
+            return result
+
+        return run
+
+    def _compile_arith(self, node):
+        ops = []
+        operands = []
+        while isinstance(node, LarkTree) and node.data in ("add", "sub"):
+            ops.append("+" if node.data == "add" else "-")
+            operands.append(node.children[1])
+            node = node.children[0]
+        operands.append(node)
+        ops.reverse()
+        thunks = [self._compile(operand) for operand in reversed(operands)]
+
+        thunk = thunks[0]
+        for start in range(0, len(ops), _MAX_CHAIN):
+            chunk = tuple(ops[start:start + _MAX_CHAIN])
+            thunk = _arith_chain(chunk)(thunk, *thunks[start + 1:start + 1 + len(chunk)])
+        return thunk
+
+    _compile_add = _compile_arith
+    _compile_sub = _compile_arith
+
+    def _compile_mul(self, node):
+        l, r = self._compile(node.children[0]), self._compile(node.children[1])
+        return lambda: l() * r()
+
+    def _compile_div(self, node):
+        l, r = self._compile(node.children[0]), self._compile(node.children[1])
+
+        def div():
+            x = l()
+            y = r()
+            if y == 0:
+                raise ZeroDivisionError(f"division by zero: {x} / {y}")
+            return x / y
+
+        return div
+
+    def _compile_eq(self, node):
+        l, r = self._compile(node.children[0]), self._compile(node.children[1])
+        return lambda: l() == r()
+
+    def _compile_ne(self, node):
+        l, r = self._compile(node.children[0]), self._compile(node.children[1])
+        return lambda: l() != r()
+
+    def _compile_lt(self, node):
+        l, r = self._compile(node.children[0]), self._compile(node.children[1])
+        return lambda: l() < r()
+
+    def _compile_le(self, node):
+        l, r = self._compile(node.children[0]), self._compile(node.children[1])
+        return lambda: l() <= r()
+
+    def _compile_gt(self, node):
+        l, r = self._compile(node.children[0]), self._compile(node.children[1])
+        return lambda: l() > r()
+
+    def _compile_ge(self, node):
+        l, r = self._compile(node.children[0]), self._compile(node.children[1])
+        return lambda: l() >= r()
 
-    def module_var(self, tree):
-        module_name = str(tree.children[0])
-        member = str(tree.children[1])
-        try:
-            mod = self._lookup_user_var(module_name)
-        except KeyError as ex:
-            raise NameError(f"undefined module: {module_name}") from ex
-        if not isinstance(mod, dict):
-            raise NameError(f"undefined module: {module_name}")
-        if member not in mod:
-            raise NameError(f"undefined module member: {module_name}.{member}")
-        return mod[member]
-
-    def module_func_call(self, tree):
-        module_name = str(tree.children[0])
-        member_name = str(tree.children[1])
-        try:
-            mod = self._lookup_user_var(module_name)
-        except KeyError as ex:
-            raise NameError(f"undefined module: {module_name}") from ex
-        if not isinstance(mod, dict):
-            raise NameError(f"undefined module: {module_name}")
-        if member_name not in mod:
-            raise NameError(f"undefined module member: {module_name}.{member_name}")
-        fn = mod[member_name]
-        args = self._eval(tree.children[2]) if len(tree.children) > 2 else []
-        if args is None:
-            args = []
-        if not callable(fn):
-            raise TypeError(f"{module_name}.{member_name} is not callable")
-        return fn(*args)
-
-    def func_call(self, tree):
-        n = str(tree.children[0])
-        args = self._eval(tree.children[1]) if len(tree.children) > 1 else []
-        if args is None:
-            args = []
-        try:
-            fn = self._lookup_var(n)
-        except KeyError:
-            raise NameError(f"undefined function: {n}")
-        if not callable(fn):
-            raise TypeError(f"{n} is not callable")
-        return fn(*args)
-
-    # Backward compatibility in case grammar uses -> call.
-    def call(self, tree):
-        return self.func_call(tree)
+    def _compile_test(self, node):
+        # Where only truthiness matters (conditions, operands of & | !), the
+        # logical operators can return Python's short-circuit value as is.
+        if isinstance(node, LarkTree):
+            if node.data == "and_op":
+                l, r = self._compile_test(node.children[0]), self._compile_test(node.children[1])
+                return lambda: l() and r()
+            if node.data == "or_op":
+                l, r = self._compile_test(node.children[0]), self._compile_test(node.children[1])
+                return lambda: l() or r()
+            if node.data == "grouped":
+                return self._compile_test(node.children[0])
+        return self._compile(node)
+
+    def _compile_and_op(self, node):
+        l, r = self._compile_test(node.children[0]), self._compile_test(node.children[1])
+        return lambda: True if l() and r() else False
+
+    def _compile_or_op(self, node):
+        l, r = self._compile_test(node.children[0]), self._compile_test(node.children[1])
+        return lambda: True if l() or r() else False
+
+    def _compile_neg(self, node):
+        operand = self._compile(node.children[0])
+        return lambda: -operand()
+
+    def _compile_not_op(self, node):
+        operand = self._compile_test(node.children[0])
+        return lambda: not operand()
+
+    def _compile_grouped(self, node):
+        return self._compile(node.children[0])
+
+    def _compile_tuple_literal(self, node):
+        items = [self._compile(node.children[0])]
+        items += self._compile_argv(node.children[1] if len(node.children) > 1 else None)
+        return lambda: tuple([t() for t in items])
+
+    def _compile_list_literal(self, node):
+        items = self._compile_argv(node.children[0] if node.children else None)
+        if not items:
+            return list
+        return lambda: [t() for t in items]
+
+    def _compile_dict_literal(self, node):
+        items_node = node.children[0] if node.children else None
+        items = [] if items_node is None else [
+            (self._compile(item.children[0]), self._compile(item.children[1]))
+            for item in items_node.children
+        ]
+        if not items:
+            return dict
+
+        def build():
+            pairs = [(key(), value()) for key, value in items]
+            result = {}
+            for key, value in pairs:
+                try:
+                    result[key] = value
+                except TypeError as ex:
+                    raise TypeError("dict key is not hashable") from ex
+            return result
+
+        return build
+
+    def _compile_var_index(self, node):
+        name = _name(node.children[0])
+        load_target = self._compile_load(name, f"undefined variable: {name}", builtins=False)
+        index_thunk = self._compile(node.children[1])
+
+        # Monomorphic inline cache: [target type, getter] from the last call.
+        cache = [None, None]
+
+        def load():
+            index = index_thunk()
+            target = load_target()
+            if type(target) is cache[0]:
+                return cache[1](target, index)
+            getter = _index_handler(_INDEX_GETTERS, target)
+            if getter is None:
+                raise TypeError(f"{name} is not indexable")
+            cache[0], cache[1] = type(target), getter
+            return getter(target, index)
+
+        return load
+
+    # Each site remembers the last exports dict it validated, so later
+    # evaluations skip the module and member checks. The member itself is
+    # read every time: exports are a plain dict and $m["v"]: x updates them.
+
+    def _compile_module_var(self, node):
+        module_name = _name(node.children[0])
+        member = _name(node.children[1])
+        load_module = self._compile_load(module_name, f"undefined module: {module_name}", builtins=False)
+        checked = [None]
+
+        def load():
+            mod = load_module()
+            if mod is checked[0]:
+                return mod[member]
+            value = _module_member(mod, module_name, member)
+            checked[0] = mod
+            return value
+
+        return load
+
+    def _compile_module_func_call(self, node):
+        module_name = _name(node.children[0])
+        member_name = _name(node.children[1])
+        load_module = self._compile_load(module_name, f"undefined module: {module_name}", builtins=False)
+        argv = self._compile_argv(node.children[2] if len(node.children) > 2 else None)
+        checked = [None]
+
+        def call():
+            mod = load_module()
+            if mod is checked[0]:
+                fn = mod[member_name]
+            else:
+                fn = _module_member(mod, module_name, member_name)
+                checked[0] = mod
+            args = [t() for t in argv]
+            if not callable(fn):
+                raise TypeError(f"{module_name}.{member_name} is not callable")
+            return fn(*args)
+
+        return call
+
+    def _compile_func_call(self, node):
+        n = _name(node.children[0])
+        load_fn = self._compile_load(n, f"undefined function: {n}")
+        argv = self._compile_argv(node.children[1] if len(node.children) > 1 else None)
+
+        def call():
+            args = [t() for t in argv]
+            fn = load_fn()
+            if not callable(fn):
+                raise TypeError(f"{n} is not callable")
+            return fn(*args)
+
+        return call
+
+    _compile_call = _compile_func_call